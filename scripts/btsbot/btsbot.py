@@ -249,38 +249,54 @@ class BTSbot(datasets.GeneratorBasedBuilder):
         """
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
+                # Reading every column in one go and casting it once, rows are then
+                # indexed from plain python lists
+                catalog = {}
+                for features, dtype in [
+                    (_FLOAT_FEATURES, 'float32'),
+                    # NOTE: includes object_id
+                    (_INT_FEATURES, 'int64'),
+                    (_BOOL_FEATURES, 'bool'),
+                    (_STRING_FEATURES, 'str'),
+                ]:
+                    for f in features:
+                        catalog[f] = data[f][:].astype(dtype).tolist()
+                bands = data['band'][:]
+                scales = data['image_scale'][:]
+                dset = data['image_triplet']
+
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Mapping requested ids to their row in the catalog
+                    id_to_row = {k: i for i, k in enumerate(catalog["object_id"])}
+                    rows = [id_to_row[k] for k in object_ids[j]]
+                    # Only the requested images are read, with a single selection over
+                    # the sorted rows, and mapped back to the requested order
+                    image_rows = np.unique(rows)
+                    triplets = np.empty((len(image_rows), *dset.shape[1:]), dtype='float32')
+                    if len(image_rows) > 0:
+                        dset.read_direct(triplets, source_sel=np.s_[image_rows])
+                    triplet_rows = np.searchsorted(image_rows, rows)
                 else:
-                    keys = data["object_id"]
-                
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(catalog["object_id"]))
+                    # Images are read straight into a float32 buffer in a single call
+                    triplets = np.empty(dset.shape, dtype='float32')
+                    dset.read_direct(triplets)
+                    triplet_rows = rows
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog 
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                for i, t in zip(rows, triplet_rows):
                     # Parse image data
                     example = {
                         'image': [
                             {
-                                'band': data['band'][i],
+                                'band': bands[i],
                                 'view': view,
-                                'array': data['image_triplet'][i, :, :, j],
-                                'scale': data['image_scale'][i],
+                                'array': triplets[t, :, :, v],
+                                'scale': scales[i],
                             }
-                            for j, view in enumerate(self._views)
+                            for v, view in enumerate(self._views)
                         ]
                     }
-                    for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype('float32')
-                    for f in _INT_FEATURES:
-                        # NOTE: includes object_id
-                        example[f] = data[f][i].astype('int64')
-                    for f in _BOOL_FEATURES:
-                        example[f] = data[f][i].astype('bool')
-                    for f in _STRING_FEATURES:
-                        example[f] = data[f][i].astype('str')
+                    for f, column in catalog.items():
+                        example[f] = column[i]
 
-                    yield str(data['object_id'][i]), example
\ No newline at end of file
+                    yield str(catalog['object_id'][i]), example
@@ -63,6 +63,9 @@ def main(args):
 
     unique_healpix = np.sort(np.unique(all_healpix))
 
+    # Row positions of each healpix in every file, computed in a single pass per file
+    healpix_rows = [meta_file.groupby('healpix').indices for meta_file in meta_files]
+
     healpix_num_digits = len(str(hp.nside2npix(16)))
     # Loop over individual healpix values, can't think of a better way to do this which
     # won't take loads of memory
@@ -73,10 +76,11 @@ def main(args):
             )
         os.makedirs(hp_dir_path, exist_ok=True)
         for ind, (img_file, meta_file) in enumerate(zip(img_files, meta_files)):
-            hp_meta = meta_file[meta_file.healpix == healpix]
-            if len(hp_meta) == 0:
+            rows = healpix_rows[ind].get(healpix)
+            if rows is None:
                 continue
-            hp_img = img_file[hp_meta.index, ...]
+            hp_meta = meta_file.iloc[rows]
+            hp_img = img_file[rows, ...]
 
             hp_meta = hp_meta.rename(
                 columns={'candid': 'object_id', 'objectId': 'OBJECT_ID_'}
@@ -3,6 +3,34 @@ import argparse
 import requests
 from tqdm import tqdm
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Size in bytes of the chunks streamed to disk
+_chunk_size = 2**20
+
+
+def download_file(file_name, url, args):
+    # Send a GET request to the Zenodo URL to download the file
+    response = requests.get(url, stream=True)
+
+    # Check if the request was successful (status code 200)
+    if args.tiny:
+        with open(os.path.join(args.destination_path, file_name), 'wb') as f:
+             # Write zip file to destination folder
+             f.write(response.content)
+    else:
+        if response.status_code == 200:
+            # Open a file in binary write mode to save the downloaded content
+            with tqdm.wrapattr(open(os.path.join(args.destination_path, file_name), "wb"), "write", miniters=1,
+                            desc=file_name, total=1 if args.tiny else int(response.headers.get('content-length'))) as fout:
+                for chunk in response.iter_content(chunk_size=_chunk_size):
+                    fout.write(chunk)
+
+    # Unzip tar.gz file
+    shutil.unpack_archive(os.path.join(args.destination_path, file_name), args.destination_path)
+
+    # Remove tar.gz file
+    os.remove(os.path.join(args.destination_path, file_name))
 
 
 def main(args):
@@ -18,29 +46,9 @@ def main(args):
     if not os.path.exists(args.destination_path):
         os.mkdir(args.destination_path)
 
-    for file_name, url in zip(file_names, urls):
-        # Send a GET request to the Zenodo URL to download the file
-        response = requests.get(url, stream=True)
-
-        # Check if the request was successful (status code 200)
-        if args.tiny:
-            with open(os.path.join(args.destination_path, file_name), 'wb') as f:
-                 # Write zip file to destination folder
-                 f.write(response.content)
-        else:
-            if response.status_code == 200:
-                # Open a file in binary write mode to save the downloaded content
-                with tqdm.wrapattr(open(os.path.join(args.destination_path, file_name), "wb"), "write", miniters=1,
-                                desc=file_name, total=1 if args.tiny else int(response.headers.get('content-length'))) as fout:
-                    for chunk in response.iter_content(chunk_size=4096):
-                        fout.write(chunk)
-                        fout.flush()
-
-        # Unzip tar.gz file
-        shutil.unpack_archive(os.path.join(args.destination_path, file_name), args.destination_path)
-
-        # Remove tar.gz file
-        os.remove(os.path.join(args.destination_path, file_name))
+    # Download both files concurrently
+    with ThreadPoolExecutor(max_workers=len(file_names)) as executor:
+        list(executor.map(lambda x: download_file(*x, args), zip(file_names, urls)))
 
     # Print a success message if the file is downloaded successfully
     print(f"Files downloaded successfully to {args.destination_path}")
@@ -4,6 +4,7 @@ from astropy.table import Table, join
 import astropy.units as u
 from unagi import hsc, task
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 import healpy as hp
 import numpy as np
 import h5py
@@ -21,131 +22,152 @@ _image_size = 160
 _pixel_scale = 0.168
 _healpix_nside = 16
 
+def _patch_name(patch_cat):
+    """ Returns the tract and patch names of a group of objects from the same patch
+    """
+    tract = patch_cat['tract'][0]
+    patch = patch_cat['patch'][0]
+    patch = f"{patch // 100},{patch % 10}"
+    return tract, patch
+
+def _load_patch(data_dir, tract, patch):
+    """ Loads the images of all filters for a given tract and patch, along with their WCS
+    """
+    images = {}
+    wcs = {}
+    for filter in _filters:
+        image_filename = os.path.join(data_dir, f'{filter}/{tract}/{patch}/calexp-{filter}-{tract}-{patch}.fits')
+        with fits.open(image_filename) as hdul:
+            images[filter] = {'image': hdul[1].copy(), 
+                              'var': hdul[3].copy(),
+                              'mask': hdul[2].copy()}
+            
+            # Converting mask to binary mask based on a set of flags
+            data = images[filter]['mask'].data 
+            maskclean = np.ones_like(data, dtype=bool)
+            set_maskbits = [0, 1, 8] # Bad pixels, saturated pixels, no data
+            for bit in set_maskbits:
+                maskclean &= (data & 2**bit)==0
+            images[filter]['mask'].data = maskclean.astype(data.dtype)
+
+            # Parsing the WCS of each extension once for the whole patch
+            wcs[filter] = {ext: WCS(images[filter][ext].header) for ext in images[filter]}
+    return images, wcs
+
 def _processing_fn(args):
     """ Function that processes all the tract and patches that fall in a given healpix index
     """
     source_catalog, data_dir, group_filename = args
 
     # Group the objects by tract and patch
-    patches = source_catalog.group_by(['tract', 'patch'])
-
-    # Loop over the bricks
-    for patch_cat in patches.groups:
-        # Create a cutout for each object in the brick
-        out_images = []
-
-        tract = patch_cat['tract'][0]
-        patch = patch_cat['patch'][0]
-        patch = f"{patch // 100},{patch % 10}"
-
-        # Load all the images for this patch
-        images = {}
-        try:
-            for filter in _filters:
-                image_filename = os.path.join(data_dir, f'{filter}/{tract}/{patch}/calexp-{filter}-{tract}-{patch}.fits')
-                with fits.open(image_filename) as hdul:
-                    images[filter] = {'image': hdul[1].copy(), 
-                                      'var': hdul[3].copy(),
-                                      'mask': hdul[2].copy()}
-                    
-                    # Converting mask to binary mask based on a set of flags
-                    data = images[filter]['mask'].data 
-                    maskclean = np.ones_like(data, dtype=bool)
-                    set_maskbits = [0, 1, 8] # Bad pixels, saturated pixels, no data
-                    for bit in set_maskbits:
-                        maskclean &= (data & 2**bit)==0
-                    images[filter]['mask'].data = maskclean.astype(data.dtype)
-        except Exception as e:
-            print(f"Failed to load image for patch {tract}, {patch}: {e}")
-            continue
-
-        for obj in patch_cat:
-            # Create a cutout for each band
-            ra, dec = obj['ra'], obj['dec']
-
-            # Build image
-            image = []
-            for band in _filters:
-                wcs = WCS(images[band]['image'].header)
-                x, y = wcs.all_world2pix(ra, dec, 1)
-                position = (x, y)
-                size = (_image_size, _image_size)
-                image.append(Cutout2D(images[band]['image'].data, position, size, wcs=wcs).data)
-            image = np.stack(image, axis=0)
-
-            # Build inverse variance
-            var = []
-            for band in _filters:
-                wcs = WCS(images[band]['var'].header)
-                x, y = wcs.all_world2pix(ra, dec, 1)
-                position = (x, y)
-                size = (_image_size, _image_size)
-                var.append(Cutout2D(images[band]['var'].data, position, size, wcs=wcs).data)
-            var = np.stack(var, axis=0)
-
-            mask = []
-            for band in _filters:
-                wcs = WCS(images[band]['mask'].header)
-                x, y = wcs.all_world2pix(ra, dec, 1)
-                position = (x, y)
-                size = (_image_size, _image_size)
-                mask.append(Cutout2D(images[band]['mask'].data, position, size, wcs=wcs).data)
-            mask = np.stack(mask, axis=0)
-
-            # Compute the PSF FWHM in arcsec
-            psf_fwhm = []
-            for f in _filters:
-                b = f.lower().split('-')[-1]
-                psf_mxx = obj[f'{b}_sdssshape_psf_shape11'].filled(fill_value=0)
-                psf_myy = obj[f'{b}_sdssshape_psf_shape22'].filled(fill_value=0)
-                psf_mxy = obj[f'{b}_sdssshape_psf_shape12'].filled(fill_value=0)
-                psf_fwhm.append(2.355 * (psf_mxx * psf_myy - psf_mxy**2)**(0.25)) # in arcsec
-            psf_fwhm = np.nan_to_num(np.array(psf_fwhm).astype(np.float32))
-
-            out_images.append({
-                    'object_id': obj['object_id'],
-                    'image_band': np.array([f.lower().encode("utf-8") for f in _filters], dtype=_utf8_filter_type),
-                    'image_ivar': np.nan_to_num(1./var),
-                    'image_array': image,
-                    'image_mask': mask.astype('bool'),
-                    'image_psf_fwhm': psf_fwhm,
-                    'image_scale': np.array([_pixel_scale for f in _filters]).astype(np.float32),
-            })
-
-        # If we didn't find any images, we return 0
-        if len(out_images) == 0:
-            continue
-
-        # Aggregate all images into an astropy table
-        images = Table({k: [d[k] for d in out_images] for k in out_images[0].keys()})
-
-        # Join on object_id with the input catalog
-        catalog = join(source_catalog, images, 'object_id', join_type='inner')
+    patches = source_catalog.group_by(['tract', 'patch']).groups
+
+    # The images of the next patch are loaded in the background while the current one is processed,
+    # so each worker holds up to two full patches (5 filters x 3 extensions each) in memory at once
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_patch = executor.submit(_load_patch, data_dir, *_patch_name(patches[0]))
+
+        # Loop over the bricks
+        for n, patch_cat in enumerate(patches):
+            # Create a cutout for each object in the brick
+            out_images = []
+
+            tract, patch = _patch_name(patch_cat)
+
+            # Load all the images for this patch
+            current_patch = next_patch
+            if n + 1 < len(patches):
+                next_patch = executor.submit(_load_patch, data_dir, *_patch_name(patches[n + 1]))
+            try:
+                images, wcs = current_patch.result()
+            except Exception as e:
+                print(f"Failed to load image for patch {tract}, {patch}: {e}")
+                continue
+
+            for obj in patch_cat:
+                # Create a cutout for each band
+                ra, dec = obj['ra'], obj['dec']
+
+                # Build image
+                image = []
+                for band in _filters:
+                    x, y = wcs[band]['image'].all_world2pix(ra, dec, 1)
+                    position = (x, y)
+                    size = (_image_size, _image_size)
+                    image.append(Cutout2D(images[band]['image'].data, position, size, wcs=wcs[band]['image']).data)
+                image = np.stack(image, axis=0)
+
+                # Build inverse variance
+                var = []
+                for band in _filters:
+                    x, y = wcs[band]['var'].all_world2pix(ra, dec, 1)
+                    position = (x, y)
+                    size = (_image_size, _image_size)
+                    var.append(Cutout2D(images[band]['var'].data, position, size, wcs=wcs[band]['var']).data)
+                var = np.stack(var, axis=0)
+
+                mask = []
+                for band in _filters:
+                    x, y = wcs[band]['mask'].all_world2pix(ra, dec, 1)
+                    position = (x, y)
+                    size = (_image_size, _image_size)
+                    mask.append(Cutout2D(images[band]['mask'].data, position, size, wcs=wcs[band]['mask']).data)
+                mask = np.stack(mask, axis=0)
+
+                # Compute the PSF FWHM in arcsec
+                psf_fwhm = []
+                for f in _filters:
+                    b = f.lower().split('-')[-1]
+                    psf_mxx = obj[f'{b}_sdssshape_psf_shape11'].filled(fill_value=0)
+                    psf_myy = obj[f'{b}_sdssshape_psf_shape22'].filled(fill_value=0)
+                    psf_mxy = obj[f'{b}_sdssshape_psf_shape12'].filled(fill_value=0)
+                    psf_fwhm.append(2.355 * (psf_mxx * psf_myy - psf_mxy**2)**(0.25)) # in arcsec
+                psf_fwhm = np.nan_to_num(np.array(psf_fwhm).astype(np.float32))
+
+                out_images.append({
+                        'object_id': obj['object_id'],
+                        'image_band': np.array([f.lower().encode("utf-8") for f in _filters], dtype=_utf8_filter_type),
+                        'image_ivar': np.nan_to_num(1./var),
+                        'image_array': image,
+                        'image_mask': mask.astype('bool'),
+                        'image_psf_fwhm': psf_fwhm,
+                        'image_scale': np.array([_pixel_scale for f in _filters]).astype(np.float32),
+                })
+
+            # If we didn't find any images, we return 0
+            if len(out_images) == 0:
+                continue
+
+            # Aggregate all images into an astropy table
+            images = Table({k: [d[k] for d in out_images] for k in out_images[0].keys()})
+
+            # Join on object_id with the input catalog
+            catalog = join(source_catalog, images, 'object_id', join_type='inner')
             
-        # Create the output directory if it does not exist
-        out_path = os.path.dirname(group_filename)
-        if not os.path.exists(out_path):
-            os.makedirs(out_path, exist_ok=True)
-
-        with FileLock(group_filename + ".lock"):
-            if os.path.exists(group_filename):
-                # Load the existing file and concatenate the data with current data
-                with h5py.File(group_filename, 'a') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        hdf5_file[key].resize(hdf5_file[key].shape[0] + shape[0], axis=0)
-                        hdf5_file[key][-shape[0]:] = catalog[key]
-            else:           
-                # This is the first time we write the file, so we define the datasets
-                with h5py.File(group_filename, 'w') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        if len(shape) == 1:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None,))
-                        else:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None, *shape[1:]))
-
-        del catalog, images, out_images
+            # Create the output directory if it does not exist
+            out_path = os.path.dirname(group_filename)
+            if not os.path.exists(out_path):
+                os.makedirs(out_path, exist_ok=True)
+
+            with FileLock(group_filename + ".lock"):
+                if os.path.exists(group_filename):
+                    # Load the existing file and concatenate the data with current data
+                    with h5py.File(group_filename, 'a') as hdf5_file:
+                        for key in catalog.colnames:
+                            shape = catalog[key].shape
+                            hdf5_file[key].resize(hdf5_file[key].shape[0] + shape[0], axis=0)
+                            hdf5_file[key][-shape[0]:] = catalog[key]
+                else:           
+                    # This is the first time we write the file, so we define the datasets
+                    with h5py.File(group_filename, 'w') as hdf5_file:
+                        for key in catalog.colnames:
+                            shape = catalog[key].shape
+                            if len(shape) == 1:
+                                hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None,))
+                            else:
+                                hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None, *shape[1:]))
+
+            del catalog, images, out_images
 
     return 1
 
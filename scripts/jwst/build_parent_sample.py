@@ -1,7 +1,8 @@
 import argparse
 import os
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from tqdm import tqdm
 
 
@@ -12,8 +13,8 @@ import requests
 
 from filelock import FileLock
 from astropy.io import fits
-from astropy.nddata.utils import Cutout2D
-from astropy.table import Table, join
+from astropy.nddata.utils import extract_array
+from astropy.table import Table
 from astropy.wcs import WCS
 from scipy.ndimage import maximum_filter
 
@@ -60,6 +61,9 @@ _s3_bucket = "grizli-v2"
 
 _utf8_filter_type = h5py.string_dtype("utf-8", 5)
 
+# Target size in bytes of the HDF5 chunks used for the cutout datasets
+_chunk_nbytes = 2**20
+
 def selection_function(cat, mag_cut, min_filters=4):
     """ Applies color cut and magnitude cut to catalog
     
@@ -84,6 +88,19 @@ def selection_function(cat, mag_cut, min_filters=4):
     sel = sel & (cat['mag_auto'] < mag_cut)
     return sel
 
+def _init_worker(filters, min_filters_cut):
+    """ Initializes the module configuration in a worker process, so that
+        changes made in the main process (e.g. by --tiny) are also seen there.
+
+    :param filters: list of str
+        Filters used in the mosaics
+    :param min_filters_cut: int
+        Minimum number of filters to retain an object in the catalog
+    """
+    global _min_filters_cut
+    _filters[:] = filters
+    _min_filters_cut = min_filters_cut
+
 def process_mosaic(mosaic, local_dir, output_dir):
     """ Function that will process a single mosaic and return a catalog with 
         cutouts for all objects in the mosaic.
@@ -130,62 +147,64 @@ def process_mosaic(mosaic, local_dir, output_dir):
         pix_scale = round(pix_scale, 4)
         img[filter]['pix_scale'] = pix_scale
         img[filter]['wcs'] = wcs
+        # Pixel positions of all objects, in a single vectorized transform
+        img[filter]['x'], img[filter]['y'] = wcs.all_world2pix(
+            np.asarray(catalog["ra"]), np.asarray(catalog["dec"]), 0
+        )
     
-    # Getting cutouts for all objects in the catalog
-    out_images = []
-    for row in catalog:
-        ra, dec = row["ra"], row["dec"]
-
-        images = []
-        invvar = []
-        for filter in filters:
-            wcs = img[filter]['wcs']
-            x, y = wcs.all_world2pix(ra, dec, 0)
-            position = (x, y)
-            size = (_cutout_size, _cutout_size)
-            images.append(Cutout2D(img[filter]['sci'].data, position, size, wcs=wcs, mode='partial',fill_value=0).data)
-            invvar.append(Cutout2D(img[filter]['wht_full'].data, position, size, wcs=wcs, mode='partial',fill_value=0).data)
-        images = np.stack(images, axis=0)
-        invvar = np.stack(invvar, axis=0)
-
-        # Convert all nans to zeros in images and invvar with np.nan_to_num
-        images = np.nan_to_num(images)
-        invvar = np.nan_to_num(invvar)
-
-        # Computing a mask
-        mask = invvar > 0
-        
-        obj_data = {
-                "object_id": row["object_id"],
-                "image_band": np.array(
-                    [f.lower().encode("utf-8") for f in filters],
-                    dtype=_utf8_filter_type,
-                ),
-                "image_ivar": invvar,
-                "image_flux": images,
-                "image_mask": mask.astype("bool"),
-                "image_psf_fwhm": np.array([_empirical_psf_fwhm[f] for f in filters]).astype(np.float32),
-                "image_scale": np.array([img[f]['pix_scale'] for f in filters]).astype(np.float32),
-            }
-        out_images.append(obj_data)
-
-    # Aggregate all images into an astropy table
-    out_images = Table({k: [d[k] for d in out_images] for k in out_images[0].keys()})
-
-    # Join on object_id with the input catalog
-    catalog = join(catalog, out_images, 'object_id', join_type='inner')
-
-    # Group the catalog by healpix index
-    catalog.group_by("healpix")
-
-    for group in catalog.groups:
-        if 'primer-cosmos' in mosaic:
-            survey = 'primer-cosmos'
-        elif 'primer-uds' in mosaic:
-            survey = 'primer-uds'
-        else:
-            survey = mosaic.split('-')[0]
-        group_filename = f"{output_dir}/{survey}/healpix={group['healpix'][0]}/001-of-001.hdf5"
+    # Getting cutouts for all objects in the catalog, directly into preallocated arrays
+    size = (_cutout_size, _cutout_size)
+    images, invvar = [
+        np.zeros(
+            (len(catalog), len(filters), *size),
+            dtype=np.result_type(*[img[f][ext].data.dtype for f in filters]).newbyteorder('='),
+        )
+        for ext in ["sci", "wht_full"]
+    ]
+    for k in range(len(catalog)):
+        for b, filter in enumerate(filters):
+            # Slicing the arrays directly, Cutout2D would also build a new WCS for each cutout
+            position = (img[filter]['y'][k], img[filter]['x'][k])
+            images[k, b] = extract_array(img[filter]['sci'].data, size, position, mode='partial', fill_value=0)
+            invvar[k, b] = extract_array(img[filter]['wht_full'].data, size, position, mode='partial', fill_value=0)
+
+    # Convert all nans to zeros in images and invvar with np.nan_to_num
+    images = np.nan_to_num(images, copy=False)
+    invvar = np.nan_to_num(invvar, copy=False)
+
+    # Adding the images to the catalog, values shared by all objects are repeated for each row
+    catalog["image_band"] = np.tile(
+        np.array([f.lower().encode("utf-8") for f in filters], dtype=_utf8_filter_type),
+        (len(catalog), 1),
+    )
+    catalog["image_ivar"] = invvar
+    catalog["image_flux"] = images
+    # Computing a mask
+    catalog["image_mask"] = invvar > 0
+    catalog["image_psf_fwhm"] = np.tile(
+        np.array([_empirical_psf_fwhm[f] for f in filters]).astype(np.float32), (len(catalog), 1)
+    )
+    catalog["image_scale"] = np.tile(
+        np.array([img[f]['pix_scale'] for f in filters]).astype(np.float32), (len(catalog), 1)
+    )
+
+    # Converting the columns to numpy once, instead of for every group and key
+    columns = {key: np.asarray(catalog[key]) for key in catalog.colnames}
+
+    if 'primer-cosmos' in mosaic:
+        survey = 'primer-cosmos'
+    elif 'primer-uds' in mosaic:
+        survey = 'primer-uds'
+    else:
+        survey = mosaic.split('-')[0]
+
+    # Group the catalog by healpix index, keeping only the row positions of each
+    # group instead of building a sub-table for it
+    order = np.argsort(columns["healpix"], kind="stable")
+    healpix_ids, starts = np.unique(columns["healpix"][order], return_index=True)
+
+    for healpix, rows in zip(healpix_ids, np.split(order, starts[1:])):
+        group_filename = f"{output_dir}/{survey}/healpix={healpix}/001-of-001.hdf5"
 
         # Create the output directory if it does not exist
         out_path = os.path.dirname(group_filename)
@@ -196,22 +215,27 @@ def process_mosaic(mosaic, local_dir, output_dir):
             if os.path.exists(group_filename):
                 # Load the existing file and concatenate the data with current data
                 with h5py.File(group_filename, 'a') as hdf5_file:
-                    for key in catalog.colnames:
+                    for key, column in columns.items():
                         # If this key does not already exist, we skip it
                         if key not in hdf5_file:
                             continue
-                        shape = catalog[key].shape
+                        group_column = column[rows]
+                        shape = group_column.shape
                         hdf5_file[key].resize(hdf5_file[key].shape[0] + shape[0], axis=0)
-                        hdf5_file[key][-shape[0]:] = catalog[key]
+                        hdf5_file[key][-shape[0]:] = group_column
             else:           
                 # This is the first time we write the file, so we define the datasets
                 with h5py.File(group_filename, 'w') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
+                    for key, column in columns.items():
+                        group_column = column[rows]
+                        shape = group_column.shape
                         if len(shape) == 1:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None,))
+                            hdf5_file.create_dataset(key, data=group_column, compression="gzip", chunks=True, maxshape=(None,))
                         else:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None, *shape[1:]))
+                            # Chunking along the object axis with chunks of about 1MB
+                            row_nbytes = np.prod(shape[1:]) * column.dtype.itemsize
+                            chunk_rows = int(max(1, _chunk_nbytes // row_nbytes))
+                            hdf5_file.create_dataset(key, data=group_column, compression="gzip", shuffle=True, chunks=(chunk_rows, *shape[1:]), maxshape=(None, *shape[1:]))
     
     del img, catalog
 
@@ -351,9 +375,9 @@ def main(args):
         list(tqdm(executor.map(lambda x: build_total_inverse_variance(*x, local_dir), maps_to_generate), total=len(maps_to_generate), desc="Building inverse variance maps"))
     print("All inverse variance maps generated.")
 
-    # Building catalog for all mosaics
-    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
-        list(tqdm(executor.map(lambda mosaic: process_mosaic(mosaic, local_dir, args.output_dir), _mosaics), total=len(_mosaics), desc="Processing mosaics"))
+    # Building catalog for all mosaics, cutout extraction is CPU bound so we use processes
+    with ProcessPoolExecutor(max_workers=args.max_workers, initializer=_init_worker, initargs=(list(_filters), _min_filters_cut)) as executor:
+        list(tqdm(executor.map(partial(process_mosaic, local_dir=local_dir, output_dir=args.output_dir), _mosaics), total=len(_mosaics), desc="Processing mosaics"))
 
     print("All done!")
 
@@ -375,7 +399,7 @@ if __name__ == "__main__":
         "--max_workers",
         type=int,
         default=1,
-        help="Number of threads for parallel downloads and processing",
+        help="Number of download threads, and of worker processes for mosaic processing; each process decompresses all the filters of one mosaic, so size this to the available memory",
     )
     parser.add_argument(
         "--tiny",
@@ -4,6 +4,8 @@ from datasets.data_files import DataFilesPatternsDict
 import numpy as np 
 import itertools
 import h5py
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 import os
 from astropy.io import fits
 from astropy.table import Row
@@ -78,6 +80,121 @@ Funding for the TESS mission is provided by the NASA Explorer Program.
 STScI is operated by the Association of Universities for Research in Astronomy, Inc., under NASA contract NAS 5–26555.
 """
 
+# Columns of the HDF5 files needed to build the examples of each pipeline, as the
+# light curve columns and the per-star columns, in the order the builders unpack them
+_PIPELINE_COLUMNS = {
+    "spoc": (
+        ["time", "flux", "flux_err", "quality"],
+        ["RA", "DEC", "object_id"],
+    ),
+    "qlp": (
+        [
+            "time", "kspsap_flux", "kspsap_flux_err", "quality", "sap_flux", "orbitid",
+            "sap_x", "sap_y", "sap_bkg", "sap_bkg_err", "kspsap_flux_sml", "kspsap_flux_lag",
+        ],
+        ["RA", "DEC", "object_id", "tess_mag", "radius", "teff", "logg", "mh"],
+    ),
+    "tglc": (
+        ["time", "psf_flux", "psf_flux_err", "aper_flux", "tess_flags", "tglc_flags"],
+        ["RA", "DEC", "object_id", "aper_flux_err"],
+    ),
+}
+
+
+def _read_column(dset):
+    """Returns the full content of an HDF5 dataset as a numpy array.
+
+    Contiguous, unfiltered numeric datasets are memory mapped directly from the file,
+    which avoids copying them through h5py. Other datasets are read with read_direct.
+    """
+    offset = dset.id.get_offset()
+    if (
+        offset is not None
+        and dset.file.driver == "sec2"
+        and dset.chunks is None
+        and dset.dtype.kind in "fiu"
+    ):
+        return np.memmap(dset.file.filename, mode="r", dtype=dset.dtype, shape=dset.shape, offset=offset)
+    array = np.empty(dset.shape, dtype=dset.dtype)
+    dset.read_direct(array)
+    return array
+
+
+def _build_spoc_example(row):
+    """Build example for SPOC pipeline"""
+    time, flux, flux_err, quality, ra, dec, object_id = row
+    return {
+        "lightcurve": {
+            'time': time,
+            'flux': flux,
+            'flux_err': flux_err,
+            'quality': quality
+        },
+        'RA': ra,
+        'DEC': dec,
+        'object_id': object_id
+    }
+
+
+def _build_qlp_example(row):
+    """Build example for QLP pipeline"""
+    (time, kspsap_flux, kspsap_flux_err, quality, sap_flux, orbitid,
+     sap_x, sap_y, sap_bkg, sap_bkg_err, kspsap_flux_sml, kspsap_flux_lag,
+     ra, dec, object_id, tess_mag, radius, teff, logg, mh) = row
+    return {
+        "lightcurve": {
+            'time': time,
+            'flux': kspsap_flux,
+            'flux_err': kspsap_flux_err,
+            'quality': quality,
+            # Keep additional QLP-specific fields
+            'sap_flux': sap_flux,
+            'orbitid': orbitid,
+            'sap_x': sap_x,
+            'sap_y': sap_y,
+            'sap_bkg': sap_bkg,
+            'sap_bkg_err': sap_bkg_err,
+            'kspsap_flux_sml': kspsap_flux_sml,
+            'kspsap_flux_lag': kspsap_flux_lag
+        },
+        'RA': ra,
+        'DEC': dec,
+        'object_id': object_id,
+        'tess_mag': tess_mag,
+        'radius': radius,
+        'teff': teff,
+        'logg': logg,
+        'mh': mh
+    }
+
+
+def _build_tglc_example(row):
+    """Build example for TGLC pipeline"""
+    (time, psf_flux, psf_flux_err, aper_flux, tess_flags, tglc_flags,
+     ra, dec, object_id, aper_flux_err) = row
+    return {
+        "lightcurve": {
+            'time': time,
+            'flux': psf_flux,
+            'flux_err': psf_flux_err,
+            'aper_flux': aper_flux,
+            'tess_flags': tess_flags,
+            'tglc_flags': tglc_flags
+        },
+        'RA': ra,
+        'DEC': dec,
+        'object_id': object_id,
+        # 'GAIADR3_ID': gaiadr3_id,
+        'aper_flux_err': aper_flux_err
+    }
+
+
+_ROW_BUILDERS = {
+    "spoc": _build_spoc_example,
+    "qlp": _build_qlp_example,
+    "tglc": _build_tglc_example,
+}
+
 
 class CustomBuilderConfig(datasets.BuilderConfig):
     def __init__(
@@ -164,8 +281,15 @@ class TESS(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "spoc"
 
-    def _get_feature_dict(self):
-        """Get features based on pipeline type"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Resolving the pipeline specific columns and example builder once
+        self._lc_cols, self._base_cols = _PIPELINE_COLUMNS[self.config.pipeline]
+        self._row_builder = _ROW_BUILDERS[self.config.pipeline]
+
+    @cached_property
+    def _features(self):
+        """Get features based on pipeline type, built once per builder"""
         # Define common light curve features that all pipelines should have
         common_lc_features = {
             'time': Value(dtype="float32"),
@@ -226,18 +350,20 @@ class TESS(datasets.GeneratorBasedBuilder):
         base_features.update(features[self.config.pipeline]["base"])
    
         features = {
-            "lightcurve": Sequence(features[self.config.pipeline]["lightcurve"]),
+            "lightcurve": {
+                key: Sequence(feature)
+                for key, feature in features[self.config.pipeline]["lightcurve"].items()
+            },
             **base_features
         }
-        return features
+        return Features(features)
 
     def _info(self):
-        features = self._get_feature_dict()
         ACKNOWLEDGEMENTS = "\n".join([f"% {line}" for line in _ACKNOWLEDGEMENTS.split("\n")])
 
         return datasets.DatasetInfo(
             description=_DESCRIPTION,
-            features=Features(features),
+            features=self._features,
             homepage=_HOMEPAGE,
             license=_LICENSE,
             # Citation for the dataset
@@ -252,10 +378,7 @@ class TESS(datasets.GeneratorBasedBuilder):
             )
         data_files = dl_manager.download_and_extract(self.config.data_files)
         if isinstance(data_files, (str, list, tuple)):
-            files = data_files
-            if isinstance(files, str):
-                files = [files]
-            files = [dl_manager.iter_files(file) for file in files]
+            files = self._iter_files(dl_manager, data_files)
             return [
                 datasets.SplitGenerator(
                     name=datasets.Split.TRAIN, gen_kwargs={"files": files}
@@ -263,113 +386,88 @@ class TESS(datasets.GeneratorBasedBuilder):
             ]
         splits = []
         for split_name, files in data_files.items():
-            if isinstance(files, str):
-                files = [files]
-            files = [dl_manager.iter_files(file) for file in files]
+            files = self._iter_files(dl_manager, files)
             splits.append(
                 datasets.SplitGenerator(name=split_name, gen_kwargs={"files": files})
             )
         return splits
 
+    def _iter_files(self, dl_manager, files):
+        """Returns an iterable of the data files behind each resolved path."""
+        if isinstance(files, str):
+            files = [files]
+        # The tiny configs only resolve a handful of hdf5 files, which are used as
+        # is instead of being walked through by dl_manager.iter_files
+        if "tiny" in self.config.name:
+            return [[file] for file in files]
+        return [dl_manager.iter_files(file) for file in files]
+
+    def _load_file(self, file, keys=None):
+        """Reads the columns needed by the pipeline from a file, restricted to the
+        requested ids if any, in the order in which the builders unpack them."""
+        with h5py.File(file, "r") as data:
+            missing = [name for name in self._lc_cols + self._base_cols if name not in data]
+            if missing:
+                raise ValueError(
+                    f"Columns {missing} needed by the {self.config.pipeline} pipeline are missing "
+                    f"from {file}, which contains {list(data.keys())}"
+                )
+            if keys is not None:
+                # Extract the indices of all requested ids in the catalog at once
+                ids = data["object_id"][:]
+                sort_index = np.argsort(ids, kind="stable")
+                sorted_ids = ids[sort_index]
+                keys = np.asarray(keys)
+                positions = np.searchsorted(sorted_ids, keys).clip(max=len(ids) - 1)
+                not_found = sorted_ids[positions] != keys if len(ids) else np.ones(len(keys), dtype=bool)
+                if not_found.any():
+                    raise ValueError(f"Object ids not found in {file}: {keys[not_found].tolist()}")
+                indices = sort_index[positions]
+                # Only the requested rows are read, in increasing order on disk, and
+                # are then put back in the requested order
+                rows, order = np.unique(indices, return_inverse=True)
+                if len(rows) == 0:
+                    return []
+
+            # Reading all the columns used by the pipeline at once, rows are then
+            # indexed in memory
+            columns = []
+            for name in self._lc_cols + self._base_cols:
+                dset = data[name]
+                if keys is not None:
+                    column = np.empty((len(rows), *dset.shape[1:]), dtype=dset.dtype)
+                    dset.read_direct(column, source_sel=np.s_[rows])
+                    column = column[order]
+                else:
+                    column = _read_column(dset)
+                # Light curves are cast to the float32 of the features once for the
+                # whole file, this is a no-op when they are already stored as such
+                if name in self._lc_cols:
+                    column = column.astype(np.float32, copy=False)
+                # Strings stored as bytes are decoded once for the whole file
+                if column.dtype.kind == "S":
+                    column = np.char.decode(column, "utf-8")
+                columns.append(column)
+        return columns
+
     def _generate_examples(self, files, object_ids=None):
         """Yields examples as (key, example) tuples."""
-        for j, file in enumerate(itertools.chain.from_iterable(files)):
-            print(f"Processing file: {file}")
-            with h5py.File(file, "r") as data:
-                if object_ids is not None:
-                    keys = object_ids[j]
-                else:
-                    keys = data["object_id"][:]
-                
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"][:])
-                sorted_ids = data["object_id"][:][sort_index]
-               
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
-                    
-                    # Build example based on pipeline type
-                    example = self._build_example(data, i)
-                    yield str(data["object_id"][i]), example
-    
-    def _build_example(self, data, i):
-        """Build example for pipeline"""
-        if self.config.pipeline == "spoc":
-            return self._build_spoc_example(data, i)
-        elif self.config.pipeline == "qlp":
-            return self._build_qlp_example(data, i)
-        elif self.config.pipeline == "tglc":
-            return self._build_tglc_example(data, i)
-        else:
-            raise ValueError(f"Pipeline {self.config.pipeline} not supported")
-
-    def _build_spoc_example(self, data, i):
-        """Build example for SPOC pipeline"""
-        return {
-            "lightcurve": {
-                'time': data["time"][i],
-                'flux': data["flux"][i],
-                'flux_err': data["flux_err"][i],
-                'quality': data["quality"][i]
-            },
-            'RA': data["RA"][i],
-            'DEC': data["DEC"][i],
-            'object_id': data["object_id"][i]
-        }
+        files = list(itertools.chain.from_iterable(files))
+        if object_ids is None:
+            object_ids = [None] * len(files)
 
-    def _build_qlp_example(self, data, i):
-        """Build example for QLP pipeline"""
-        try:
-            return {
-                "lightcurve": {
-                    'time': data["time"][i],
-                    'flux': data["kspsap_flux"][i],
-                    'flux_err': data["kspsap_flux_err"][i],
-                    'quality': data["quality"][i],
-                    # Keep additional QLP-specific fields
-                    'sap_flux': data["sap_flux"][i],
-                    'orbitid': data["orbitid"][i],
-                    'sap_x': data["sap_x"][i],
-                    'sap_y': data["sap_y"][i],
-                    'sap_bkg': data["sap_bkg"][i],
-                    'sap_bkg_err': data["sap_bkg_err"][i],
-                    'kspsap_flux_sml': data["kspsap_flux_sml"][i],
-                    'kspsap_flux_lag': data["kspsap_flux_lag"][i]
-                },
-                'RA': data["RA"][i],
-                'DEC': data["DEC"][i],
-                'object_id': data["object_id"][i],
-                'tess_mag': data["tess_mag"][i],
-                'radius': data["radius"][i],
-                'teff': data["teff"][i],
-                'logg': data["logg"][i],
-                'mh': data["mh"][i]
-            }
-        except Exception as e:
-            print(f"Error in QLP example building: {str(e)}")
-            print(f"Available keys: {list(data.keys())}")
-            raise
-
-    def _build_tglc_example(self, data, i):
-        """Build example for TGLC pipeline"""
-        try:
-            return {
-                "lightcurve": {
-                    'time': data["time"][i],
-                    'flux': data["psf_flux"][i],
-                    'flux_err': data["psf_flux_err"][i],
-                    'aper_flux': data["aper_flux"][i],
-                    'tess_flags': data["tess_flags"][i],
-                    'tglc_flags': data["tglc_flags"][i]
-                },
-                'RA': data["RA"][i],
-                'DEC': data["DEC"][i],
-                'object_id': data["object_id"][i],
-                # 'GAIADR3_ID': data["GAIADR3_ID"][i],
-                'aper_flux_err': data["aper_flux_err"][i]
-            }
-        except Exception as e:
-            print(f"Error in TGLC example building: {str(e)}")
-            print(f"Available keys: {list(data.keys())}")
-            raise
+        build_example = self._row_builder
+
+        # The next file is loaded in the background while the examples of the
+        # current one are being consumed
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_columns = executor.submit(self._load_file, files[0], object_ids[0]) if files else None
+            for j, file in enumerate(files):
+                print(f"Processing file: {file}")
+                columns = next_columns.result()
+                if j + 1 < len(files):
+                    next_columns = executor.submit(self._load_file, files[j + 1], object_ids[j + 1])
+
+                for row in zip(*columns):
+                    example = build_example(row)
+                    yield str(example["object_id"]), example